@@ -1,25 +1,89 @@
 # MicToggler
 # (c) 2015 Steven Scott
 
-import random
+import ast
 import datetime
+import gc
 import time
 import os.path
 import threading
 import inspect
 import subprocess as sp
+import ctypes
 import wx
 import wx.lib.masked
 import sys
-import threading
+import numpy as np
+try:
+	from numba import njit
+except ImportError: # numba is optional; scale_clip falls back to plain numpy
+	njit = None
+try:
+	import comtypes
+	from pycaw.pycaw import AudioUtilities, IAudioEndpointVolume, IMMDeviceEnumerator, \
+		CLSID_MMDeviceEnumerator
+except ImportError: # pycaw is optional; MicToggler falls back to MixerVolume or nircmd
+	AudioUtilities = None
+
+try:
+	_monotonic = time.monotonic
+except AttributeError: # Python 2; time.clock is a high-resolution counter on Windows
+	_monotonic = time.clock if os.name == 'nt' else time.time
+try:
+	_monotonic_ns = time.monotonic_ns
+except AttributeError: # before Python 3.7
+	def _monotonic_ns():
+		return int(_monotonic()*1e9)
+
+# Random number generator used by StepDistribution: numpy's Generator (PCG64) where
+# available, otherwise a RandomState (Mersenne Twister) for older numpy versions
+_makeRng = getattr(np.random, 'default_rng', np.random.RandomState)
+_rng = _makeRng()
+
+def _scale_clip_numpy(samples, avg, std, lo, hi):
+	'''Returns avg + std*samples, with values outside [lo, hi] set to the closest endpoint'''
+	out = np.multiply(samples, std) # the only allocation; the rest is done in place
+	out += avg
+	return np.clip(out, lo, hi, out=out)
+
+def _scale_clip_loop(samples, avg, std, lo, hi):
+	'''Version of _scale_clip_numpy for numba to compile: scales, shifts and clips each 
+	sample in a single pass, without the temporary arrays numpy needs for each step'''
+	out = np.empty(samples.size)
+	for i in range(samples.size):
+		out[i] = min(hi, max(lo, avg + std*samples[i]))
+	return out
 
-class StepDistribution:
+scale_clip = _scale_clip_numpy
+if njit is not None:
+	# With an explicit signature numba compiles (or loads from its cache) at import time,
+	# not on the first call.  A frozen (py2exe) build has no source file for numba to 
+	# keep its cache next to, so it compiles every time instead.
+	try:
+		scale_clip = njit('float64[:](float64[:], float64, float64, float64, float64)', 
+						  cache=not getattr(sys, 'frozen', False), fastmath=True, 
+						  error_model='numpy')(_scale_clip_loop)
+	except Exception: # numba could not compile or cache it here; use plain numpy
+		pass
+
+class StepDistribution(object):
 	'''Class for creating and storing a distribution of on/off steps'''
 	path = 'D:/mictoggler/' # Only used for command-line version
 	datapath = os.path.join(path, 'data')
 	listStartMarker = 'STEPLIST\r\n'
+	binaryExtension = '.npz' # binary copy of the step list, saved next to the text file
+	# Parameters used for generation, and summary statistics of the generated steps
+	paramFields = ('nSteps', 'fracOn', 'avgDurOn', 'stdDurOn', 'minDurOn', 
+				   'maxDurOn', 'avgDurOff', 'stdDurOff', 'minDurOff', 'maxDurOff')
+	summaryFields = ('fracStepsOn', 'fracTimeOn', 'timeTotal')
 	nInstances = 0;
 	
+	# Shared buffer of standard normal samples, refilled in large batches by _draw
+	gaussPoolSize = 1000000
+	gaussPoolMaxDraw = 4096 # larger draws are faster straight from the generator
+	_gaussPool = np.empty(0)
+	_gaussPos = 0
+	
 	def __init__(self, paramsOrFile):
 		'''Create a new StepDistribution object with Gaussian-distributed on/off times
 		
@@ -34,6 +98,8 @@ class StepDistribution:
 		stdDurOff: standard deviation (s) for the Gaussian distribution used for OFF steps
 		minDurOff: minimum duration (s) of OFF steps
 		maxDurOff: maximum duration (s) of OFF steps
+		seed: (optional) seed for the random number generator, to make the generated 
+			distribution reproducible
 		
 		This initializes the values of the parameters used for generating the list of 
 		steps but does NOT itself generate a distribution.
@@ -46,13 +112,15 @@ class StepDistribution:
 		fracStepsOn, and timeTotal.  These refer to the actual distribution generated and
 		not the parameters used to generate it.'''
 		
+		self.rng = None # own generator, only used if a seed is given
 		if type(paramsOrFile) == type({}):
 			self.params = paramsOrFile
-			# Convert fields to floats
-			expectedFields = ['nSteps', 'fracOn', 'avgDurOn', 'stdDurOn', 'minDurOn', 
-				  'maxDurOn', 'avgDurOff', 'stdDurOff', 'minDurOff', 'maxDurOff']
-			for eF in expectedFields:
+			if 'seed' in self.params:
+				self.rng = _makeRng(self.params['seed'])
+			# Convert fields to floats, except the number of steps which is a whole number
+			for eF in self.paramFields:
 				self.params[eF] += 0.0
+			self.params['nSteps'] = int(round(self.params['nSteps']))
 			# Require all delays nonnegative
 			self.params['minDurOn'] = max(self.params['minDurOn'], 0.0)
 			self.params['maxDurOn'] = max(self.params['maxDurOn'], 0.0)
@@ -69,76 +137,124 @@ class StepDistribution:
 		
 		Expects the full path to a .txt file with a header section that defines all of the 
 		variables accepted by __init__ and a body with the actual list of on/off steps, each
-		on its own line and represented as OnOff[boolean], Duration[float]'''
-		stillInHeader = True
-		stepList = []
+		on its own line and represented as OnOff[boolean], Duration[float].  If an up-to-date
+		binary copy of the step list (see save_distribution) exists, the steps are read 
+		from that instead of from the text.'''
 		self.params = {}
 		with open(filepath, 'r') as f:
-			for line in f:
-				if stillInHeader:
-					if '=' in line:
-						self.read_var(line)
-						
-					if line.strip() == self.listStartMarker.strip():
-						stillInHeader = False
-				else:
-					vals = line.strip().split(',')
-					tup = (vals[0]=='True', float(vals[1]))
-					stepList.append(tup)
-					
-		self.stepList = stepList
-		
-		expectedFields = ['nSteps', 'fracOn', 'avgDurOn', 'stdDurOn', 'minDurOn', 
-				  'maxDurOn', 'avgDurOff', 'stdDurOff', 'minDurOff', 'maxDurOff',
-				  'fracStepsOn', 'fracTimeOn', 'timeTotal']
-				  
-		for f in expectedFields:
+			# Read the header line by line (readline rather than iterating over f, so
+			# that the file position is left exactly at the start of the step list)
+			line = f.readline()
+			while line and line.strip() != self.listStartMarker.strip():
+				if '=' in line:
+					self.read_var(line)
+				line = f.readline()
+			
+			# Use the binary copy of the steps if there is one; otherwise parse the rest
+			# of the file (the step list) in one pass
+			if not self.load_binary(filepath):
+				steps = np.loadtxt(f, delimiter=',', dtype=[('on', 'U5'), ('dur', np.float64)], ndmin=1)
+				self.on = steps['on'] == 'True'
+				self.dur = steps['dur']
+		self._stepList = None
+		
+		for f in self.paramFields + self.summaryFields:
 			if f not in self.params:
 				raise IOError('Expected parameter missing from file')
+		self.params['nSteps'] = int(round(self.params['nSteps'])) # older files store a float
+		
+	def load_binary(self, filepath):
+		'''Sets self.on and self.dur from the binary copy of the step list saved alongside
+		the text file filepath.  Returns False, without changing anything, if there is no
+		such copy, it is older than the text file, it cannot be read, or its steps do not
+		match the nSteps and timeTotal already read from the text file's header (e.g. 
+		because the text file was replaced by a copy that kept its modification time).'''
+		binpath = filepath + self.binaryExtension
+		try:
+			if os.path.getmtime(binpath) < os.path.getmtime(filepath):
+				return False
+			with np.load(binpath) as data:
+				(on, dur) = (data['on'], data['dur'])
+		except Exception:
+			return False
+		if on.shape != dur.shape:
+			return False
+		try:
+			(nSteps, timeTotal) = (self.params['nSteps'], self.params['timeTotal'])
+		except KeyError:
+			return False
+		if on.size != int(round(nSteps)) or abs(float(dur.sum()) - timeTotal) > 1e-6 * max(1., abs(timeTotal)):
+			return False
+		self.on = on.astype(bool)
+		self.dur = dur.astype(np.float64)
+		return True
 		
 	def read_var(self, line):
 		'''Helper function to set the current value of a variable based on a text file'''
-		lineparts = line.strip().split('=')
-		exec('self.params["' + lineparts[0] + '"] = ' + lineparts[1])
+		(varString, value) = line.strip().split('=', 1)
+		self.params[varString] = ast.literal_eval(value.strip())
 		
 	def bounded_gaussian_list(self, nElem, avgDur, stdDur, minDur, maxDur):
-		''' Generate a list of gaussian-distributed elements
-	
-		Returns a list of length nElem, each element of which is sampled
+		''' Generate an array of gaussian-distributed elements
+
+		Returns an array of length nElem, each element of which is sampled
 		from a Gaussian distribution with mean avgDur and standard deviation
-		stdDur. Any elements below minDur or above maxDur will be replaced with 
+		stdDur. Any elements below minDur or above maxDur will be replaced with
 		the min/max values respectively (rather than resampled). '''
-		
-		steps = [random.gauss(avgDur, stdDur) for _ in range(nElem)]
-		return map(lambda x: min(max(minDur, x), maxDur), steps)
+
+		nElem = int(nElem)
+		if self.rng is not None:
+			# Seeded: draw from our own generator so the result does not depend on the pool
+			samples = self.rng.standard_normal(nElem)
+		elif nElem <= self.gaussPoolMaxDraw:
+			samples = self._draw(nElem)
+		else:
+			samples = _rng.standard_normal(nElem)
+		return scale_clip(samples, float(avgDur), float(stdDur), float(minDur), float(maxDur))
+
+	@classmethod
+	def _draw(cls, nElem):
+		'''Returns an array of nElem standard normal samples taken from the shared pool.
+		
+		The pool is refilled with gaussPoolSize new samples whenever it runs out, so
+		that many small distributions share the cost of one large draw.  Only used for
+		nElem up to gaussPoolMaxDraw (see bounded_gaussian_list).'''
+		if cls._gaussPos + nElem > cls._gaussPool.size:
+			# numpy's own sampler already runs in C; an explicit array-wise Box-Muller
+			# (uniform draws + log/sqrt/cos/sin) measured ~1.3x slower for this buffer
+			cls._gaussPool = _rng.standard_normal(cls.gaussPoolSize)
+			cls._gaussPos = 0
+		samples = cls._gaussPool[cls._gaussPos:cls._gaussPos + nElem]
+		cls._gaussPos += nElem
+		return samples
 
 	def __set_seq(self):
 		'''Generates a list of on/off steps based on the current parameters.
 		
-		Sets self.stepList to a list of tuples (OnOff[boolean], Duration[float]).
-		The durations of on steps and off steps are Gaussian-distributed as per the 
-		means and standard deviations set upon initialization, except that values sampled
-		outside the [min, max] range are set to the closest endpoint.'''
+		Sets self.on (boolean array) and self.dur (float array) so that step i is on
+		if self.on[i] and lasts self.dur[i] seconds.  The durations of on steps and off 
+		steps are Gaussian-distributed as per the means and standard deviations set upon 
+		initialization, except that values sampled outside the [min, max] range are set
+		to the closest endpoint.'''
 	
 		# Decide how many 'on' and 'off' timesteps
-		nOn = round(self.params['fracOn'] * self.params['nSteps'])
-		nOff = self.params['nSteps'] - nOn
+		self._nOn = int(round(self.params['fracOn'] * self.params['nSteps']))
+		self._nOff = self.params['nSteps'] - self._nOn
 	
-		# Make lists of 'on' and 'off' timesteps separately, using individual params
-		# Each step is represented as a tuple: (Boolean, double) where the first 
-		# element can be True (on) or False (off) and the second gives the duration.
-		onList	= self.bounded_gaussian_list(int(nOn),	self.params['avgDurOn'],	 self.params['stdDurOn'],  
+		# Make arrays of 'on' and 'off' durations separately, using individual params
+		onDur	= self.bounded_gaussian_list(self._nOn,	self.params['avgDurOn'],	 self.params['stdDurOn'],
 											  self.params['minDurOn'],	self.params['maxDurOn'])
-		onList = map(lambda val: (True, val), onList)
-	
-		offList = self.bounded_gaussian_list(int(nOff), self.params['avgDurOff'], self.params['stdDurOff'], 
+
+		offDur = self.bounded_gaussian_list(self._nOff, self.params['avgDurOff'], self.params['stdDurOff'],
 											  self.params['minDurOff'], self.params['maxDurOff'])
-		offList = map(lambda val: (False, val), offList)
 	
-		# Combine and shuffle on and off lists
-		steps = onList + offList
-		random.shuffle(steps)
-		self.stepList = steps
+		# Combine on and off steps and shuffle them jointly
+		on = np.concatenate([np.ones(self._nOn, dtype=bool), np.zeros(self._nOff, dtype=bool)])
+		dur = np.concatenate([onDur, offDur])
+		perm = (self.rng or _rng).permutation(on.size)
+		self.on = on[perm]
+		self.dur = dur[perm]
+		self._stepList = None
 		(self.params['fracStepsOn'], self.params['fracTimeOn'], self.params['timeTotal']) = self.__distribution_details()
 
 	def save_distribution(self, filepath=""):
@@ -147,7 +263,10 @@ class StepDistribution:
 		Header section includes all current parameters (those given to __init__) and
 		summary statistics (actual fraction of steps on, actual fraction of time on, and
 		total time) in the format varName=value (one value per line).  Body contains 
-		the list of steps (one step per line) in the format OnOff[boolean],Duration[float]'''
+		the list of steps (one step per line) in the format OnOff[boolean],Duration[float]
+		
+		A binary copy of the steps is also saved as filepath + binaryExtension, which 
+		load_file uses to skip parsing the text.'''
 		
 		if filepath == "":
 			timestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y%m%d%H%M%S')
@@ -162,46 +281,46 @@ class StepDistribution:
 				pass
 			filepath = os.path.join(self.datapath, filename)		
 
-		f = open(filepath, 'w+')
+		header = ['Summary statistics'] + [self.format_var(var) for var in self.summaryFields] + \
+				 ['Parameters used in generation'] + [self.format_var(var) for var in self.paramFields]
 		
-		f.write('Summary statistics\r\n')
-		for var in ['fracStepsOn', 'fracTimeOn', 'timeTotal']:
-			self.write_var(f, var)
-			
-		f.write('Parameters used in generation\r\n')
-		for var in ['nSteps', 'fracOn', 'avgDurOn', 'stdDurOn', 'minDurOn', 'maxDurOn', 
-										'avgDurOff','stdDurOff','minDurOff','maxDurOff']:
-			self.write_var(f,var)
-
-		f.write(self.listStartMarker)
-		for step in self.stepList:
-			f.write(str(step[0])+ ',' + str(step[1]) + '\r\n')
-
-		f.close()
+		with open(filepath, 'w+') as f:
+			f.write('\r\n'.join(header) + '\r\n' + self.listStartMarker)
+			# Format the whole step list up front and write it in one call
+			f.write(''.join([str(isOn) + ',' + str(dur) + '\r\n'
+							 for (isOn, dur) in zip(self.on.tolist(), self.dur.tolist())]))
+		np.savez(filepath + self.binaryExtension, on=self.on, dur=self.dur)
 		
 		return filepath
 
-		
-	def write_var(self, f, varString):
-		'''Helper function to write a variable to a text file'''
-		f.write(varString + '=' + str(eval('self.params["' + varString + '"]')) + '\r\n')
+	@property
+	def stepList(self):
+		'''List of tuples (OnOff[boolean], Duration[float]), built from self.on and self.dur
+		the first time it is needed'''
+		if self._stepList is None:
+			self._stepList = zip(self.on.tolist(), self.dur.tolist())
+		return self._stepList
+		
+	def format_var(self, varString):
+		'''Helper function to format a variable as a line of a text file (inverse of read_var)'''
+		return '%s=%r' % (varString, self.params[varString])
 		
 
 
 	def __distribution_details(self):
 		''' Returns summary statistics for a list of timesteps.
 	
-		Expects a list stepList of tuples (isStepOn, stepDuration) with 
-		boolean first element and double second element.  Returns a 3-tuple
-		with summary statistics: (fracOn, timeOn, timeTotal)
+		Expects self.on (boolean array, whether each step is on) and self.dur 
+		(float array, duration of each step).  Returns a 3-tuple with summary 
+		statistics: (fracOn, timeOn, timeTotal)
 	
-		fracStepsOn: what fraction of the steps have first element True
-		fracTimeOn: total stepDuration for steps that are on / total stepDuration
-		timeTotal: total stepDuration of all steps'''
+		fracStepsOn: what fraction of the steps are on
+		fracTimeOn: total duration of steps that are on / total duration
+		timeTotal: total duration of all steps'''
 	
-		fracStepsOn = (sum([step[0] for step in self.stepList]) + 0.0)/len(self.stepList)
-		timeTotal = sum([step[1] for step in self.stepList])
-		fracTimeOn = sum([step[1] if step[0] else 0 for step in self.stepList])/timeTotal
+		fracStepsOn = float(self.on.mean())
+		timeTotal = float(self.dur.sum())
+		fracTimeOn = float(np.dot(self.on, self.dur))/timeTotal
 
 	
 		return (fracStepsOn, fracTimeOn, timeTotal)
@@ -211,30 +330,278 @@ class StepDistribution:
 
 	
 
+# Structures and constants for the winmm mixer API, used by MixerVolume.  mmsystem.h
+# uses byte packing throughout, hence _pack_ = 1 in each structure.
+MMSYSERR_NOERROR = 0
+MIXER_OBJECTF_HMIXER = 0x80000000
+MIXER_GETLINEINFOF_SOURCE = 0x1
+MIXER_GETLINEINFOF_COMPONENTTYPE = 0x3
+MIXER_GETLINECONTROLSF_ONEBYTYPE = 0x2
+MIXER_SETCONTROLDETAILSF_VALUE = 0x0
+MIXERLINE_COMPONENTTYPE_DST_WAVEIN = 0x7
+MIXERCONTROL_CONTROLTYPE_VOLUME = 0x50030001
+
+class MIXERCAPS(ctypes.Structure):
+	_pack_ = 1
+	_fields_ = [('wMid', ctypes.c_uint16), ('wPid', ctypes.c_uint16), 
+				('vDriverVersion', ctypes.c_uint32), ('szPname', ctypes.c_wchar * 32), 
+				('fdwSupport', ctypes.c_uint32), ('cDestinations', ctypes.c_uint32)]
+
+class MIXERLINE(ctypes.Structure):
+	_pack_ = 1
+	_fields_ = [('cbStruct', ctypes.c_uint32), ('dwDestination', ctypes.c_uint32), 
+				('dwSource', ctypes.c_uint32), ('dwLineID', ctypes.c_uint32), 
+				('fdwLine', ctypes.c_uint32), ('dwUser', ctypes.c_void_p), 
+				('dwComponentType', ctypes.c_uint32), ('cChannels', ctypes.c_uint32), 
+				('cConnections', ctypes.c_uint32), ('cControls', ctypes.c_uint32), 
+				('szShortName', ctypes.c_wchar * 16), ('szName', ctypes.c_wchar * 64), 
+				('dwType', ctypes.c_uint32), ('dwDeviceID', ctypes.c_uint32), 
+				('wMid', ctypes.c_uint16), ('wPid', ctypes.c_uint16), 
+				('vDriverVersion', ctypes.c_uint32), ('szPname', ctypes.c_wchar * 32)]
+
+class MIXERCONTROL(ctypes.Structure):
+	_pack_ = 1
+	_fields_ = [('cbStruct', ctypes.c_uint32), ('dwControlID', ctypes.c_uint32), 
+				('dwControlType', ctypes.c_uint32), ('fdwControl', ctypes.c_uint32), 
+				('cMultipleItems', ctypes.c_uint32), ('szShortName', ctypes.c_wchar * 16), 
+				('szName', ctypes.c_wchar * 64), ('dwMinimum', ctypes.c_uint32), 
+				('dwMaximum', ctypes.c_uint32), ('dwReserved', ctypes.c_uint32 * 4), 
+				('cSteps', ctypes.c_uint32), ('cbCustomData', ctypes.c_uint32), 
+				('dwMetricsReserved', ctypes.c_uint32 * 4)]
+
+class MIXERLINECONTROLS(ctypes.Structure):
+	_pack_ = 1
+	_fields_ = [('cbStruct', ctypes.c_uint32), ('dwLineID', ctypes.c_uint32), 
+				('dwControlType', ctypes.c_uint32), ('cControls', ctypes.c_uint32), 
+				('cbmxctrl', ctypes.c_uint32), ('pamxctrl', ctypes.POINTER(MIXERCONTROL))]
+
+class MIXERCONTROLDETAILS(ctypes.Structure):
+	_pack_ = 1
+	_fields_ = [('cbStruct', ctypes.c_uint32), ('dwControlID', ctypes.c_uint32), 
+				('cChannels', ctypes.c_uint32), ('hwndOwner', ctypes.c_void_p), 
+				('cbDetails', ctypes.c_uint32), ('paDetails', ctypes.c_void_p)]
+
+class MixerVolume():
+	'''Sets the volume of a recording device in-process through the winmm mixer API,
+	so that MicToggler does not have to launch nircmd for every step'''
+	
+	def __init__(self, micName):
+		'''Opens the mixer of the recording device called micName (either exactly or as
+		reported by Windows, e.g. "Microphone (USB Audio)") and finds its volume control.
+		Raises OSError if no such device or volume control can be found.'''
+		self.handle = ctypes.c_void_p()
+		self.winmm = ctypes.WinDLL('winmm')
+		caps = MIXERCAPS()
+		for iMixer in range(self.winmm.mixerGetNumDevs()):
+			if self.winmm.mixerGetDevCapsW(iMixer, ctypes.byref(caps), ctypes.sizeof(caps)) != MMSYSERR_NOERROR:
+				continue
+			# Mixer names are cut off at 31 characters
+			if caps.szPname == micName[:31] or caps.szPname.startswith(micName + ' ('):
+				if self.winmm.mixerOpen(ctypes.byref(self.handle), iMixer, 0, 0, 0) == MMSYSERR_NOERROR:
+					break
+		else:
+			raise OSError('No mixer found for ' + micName)
+		
+		self.control = self.findVolumeControl()
+		if self.control is None:
+			self.close()
+			raise OSError('No volume control found for ' + micName)
+		
+		# Preallocate the structures passed on every volume change
+		self.value = ctypes.c_uint32(0)
+		self.details = MIXERCONTROLDETAILS(cbStruct=ctypes.sizeof(MIXERCONTROLDETAILS), 
+			dwControlID=self.control.dwControlID, cChannels=1, 
+			cbDetails=ctypes.sizeof(self.value), paDetails=ctypes.addressof(self.value))
+		self.setLevel(100)
+		
+	def __del__(self):
+		self.close()
+		
+	def close(self):
+		'''Release the mixer handle'''
+		if self.handle:
+			self.winmm.mixerClose(self.handle)
+			self.handle = ctypes.c_void_p()
+			
+	def attach(self):
+		'''Nothing to do: the mixer handle can be used from any thread (see EndpointVolume)'''
+		
+	def detach(self):
+		'''Nothing to do (see attach)'''
+		
+	def findVolumeControl(self):
+		'''Returns the MIXERCONTROL for the volume of the recording line, looking first at
+		the wave-in destination line and then at each of its source lines, or None.'''
+		line = MIXERLINE(cbStruct=ctypes.sizeof(MIXERLINE), 
+			dwComponentType=MIXERLINE_COMPONENTTYPE_DST_WAVEIN)
+		if self.winmm.mixerGetLineInfoW(self.handle, ctypes.byref(line), 
+				MIXER_OBJECTF_HMIXER | MIXER_GETLINEINFOF_COMPONENTTYPE) != MMSYSERR_NOERROR:
+			return None
+		lineIDs = [line.dwLineID]
+		for iSource in range(line.cConnections):
+			source = MIXERLINE(cbStruct=ctypes.sizeof(MIXERLINE), 
+				dwDestination=line.dwDestination, dwSource=iSource)
+			if self.winmm.mixerGetLineInfoW(self.handle, ctypes.byref(source), 
+					MIXER_OBJECTF_HMIXER | MIXER_GETLINEINFOF_SOURCE) == MMSYSERR_NOERROR:
+				lineIDs.append(source.dwLineID)
+		
+		for lineID in lineIDs:
+			control = MIXERCONTROL(cbStruct=ctypes.sizeof(MIXERCONTROL))
+			lineControls = MIXERLINECONTROLS(cbStruct=ctypes.sizeof(MIXERLINECONTROLS), 
+				dwLineID=lineID, dwControlType=MIXERCONTROL_CONTROLTYPE_VOLUME, cControls=1, 
+				cbmxctrl=ctypes.sizeof(MIXERCONTROL), pamxctrl=ctypes.pointer(control))
+			if self.winmm.mixerGetLineControlsW(self.handle, ctypes.byref(lineControls), 
+					MIXER_OBJECTF_HMIXER | MIXER_GETLINECONTROLSF_ONEBYTYPE) == MMSYSERR_NOERROR:
+				return control
+		return None
+		
+	def setLevel(self, percLevel):
+		'''Set level (0-100) to use as 'full volume', converted once to the control's units'''
+		span = self.control.dwMaximum - self.control.dwMinimum
+		self.loudValue = self.control.dwMinimum + int(round(span*percLevel/100.))
+		self.silentValue = self.control.dwMinimum
+		
+	def setVolume(self, value):
+		'''Set the control to value (in the control's units); returns True on success'''
+		self.value.value = value
+		return self.winmm.mixerSetControlDetails(self.handle, ctypes.byref(self.details), 
+			MIXER_OBJECTF_HMIXER | MIXER_SETCONTROLDETAILSF_VALUE) == MMSYSERR_NOERROR
+		
+	def makeLoud(self):
+		return self.setVolume(self.loudValue)
+		
+	def makeSilent(self):
+		return self.setVolume(self.silentValue)
+
+class EndpointVolume():
+	'''Sets the volume of a recording device in-process through its Core Audio 
+	IAudioEndpointVolume interface (using pycaw).  The device is looked up only once; 
+	the interface is activated by the thread that uses it (see attach), since COM 
+	interfaces cannot be passed between threads without marshalling.'''
+	
+	def __init__(self, micName):
+		'''Finds the id of the audio endpoint called micName (either exactly or as 
+		reported by Windows, e.g. "Microphone (USB Audio)").  Raises OSError if pycaw is
+		not available or there is no such endpoint.'''
+		if AudioUtilities is None:
+			raise OSError('pycaw is not available')
+		self.deviceId = None
+		for device in AudioUtilities.GetAllDevices():
+			name = device.FriendlyName or ''
+			if name == micName or name.startswith(micName + ' ('):
+				self.deviceId = device.id
+				break
+		if self.deviceId is None:
+			raise OSError('No audio endpoint found for ' + micName)
+		self.endpoint = None
+		self.setLevel(100)
+		
+	def attach(self):
+		'''Activate the endpoint's volume interface for use by the calling thread, which
+		must have initialized COM (and call detach before uninitializing it).  Until
+		then, setVolume fails.  Returns True on success.'''
+		try:
+			enumerator = comtypes.CoCreateInstance(CLSID_MMDeviceEnumerator, 
+				IMMDeviceEnumerator, comtypes.CLSCTX_INPROC_SERVER)
+			interface = enumerator.GetDevice(self.deviceId).Activate(
+				IAudioEndpointVolume._iid_, comtypes.CLSCTX_ALL, None)
+			self.endpoint = interface.QueryInterface(IAudioEndpointVolume)
+		except Exception:
+			self.endpoint = None
+		return self.endpoint is not None
+		
+	def detach(self):
+		'''Release the volume interface activated by attach'''
+		self.endpoint = None
+		
+	def close(self):
+		self.detach()
+		
+	def setLevel(self, percLevel):
+		'''Set level (0-100) to use as 'full volume'.'''
+		self.loudValue = min(max(percLevel/100., 0.), 1.)
+		
+	def setVolume(self, value):
+		'''Set the endpoint volume to value (0-1); returns True on success'''
+		try:
+			self.endpoint.SetMasterVolumeLevelScalar(value, None)
+		except Exception:
+			return False
+		return True
+		
+	def makeLoud(self):
+		return self.setVolume(self.loudValue)
+		
+	def makeSilent(self):
+		return self.setVolume(0.)
+
 class MicToggler():
 	'''Class to handle turning microphone levels up/down according to a sequence of steps'''
 	path = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 	appPath = os.path.join(path, 'nircmd', 'nircmd')
+	THREAD_PRIORITY_TIME_CRITICAL = 15 # from winbase.h
+	COINIT_MULTITHREADED = 0x0 # from objbase.h
+	gcMinGap = 0.1 # collect garbage after a step that lasts at least this long (s)...
+	gcMaxInterval = 5 # ...or, failing that, after at most this long without (s)
+	
+	# Automatic garbage collection is turned off while any MicToggler is toggling (see 
+	# __holdGc); these track how many are and whether it was on before the first started
+	_gcHolds = 0
+	_gcWasEnabled = True
+	_gcLock = threading.Lock()
 
-	def __init__(self, sequence, level=100, micName="Microphone"):
+	def __init__(self, sequence, level=100, micName="Microphone", onFinished=None):
 		'''Creates a MicToggler object to server a sequence of steps.  sequence should be
 		a list of tuples of the form (onoff, duration) where onoff is a Boolean determining
 		whether the microphone goes to full volume (True) or silent (False) this step and 
-		duration is the length of the step in seconds.  level is the microphone level that should
+		duration is the length of the step in seconds, or a StepDistribution (whose on and 
+		dur arrays are used directly).  level is the microphone level that should
 		be set during 'full volume' periods as a percentage of true full volume (0-100).  
-		micName is the name of the microphone that should be turned up/down.'''
-		self.sequence = sequence
+		micName is the name of the microphone that should be turned up/down.  onFinished, 
+		if given, is called with no arguments from the toggling thread when the sequence
+		has played to the end (but not when it is stopped early).'''
+		# Store the sequence as contiguous arrays: whether each step is on, and when it ends
+		# in whole milliseconds (finer than the volume can usefully be switched)
+		if hasattr(sequence, 'on') and hasattr(sequence, 'dur'):
+			self._on = np.asarray(sequence.on, dtype=bool)
+			dur = np.asarray(sequence.dur, dtype=np.float64)
+		else:
+			self._on = np.asarray([step[0] for step in sequence], dtype=bool)
+			dur = np.asarray([step[1] for step in sequence], dtype=np.float64)
+		# Round the end time of each step (from the start of the sequence) rather than each
+		# duration, so rounding errors do not add up over the sequence
+		stepEndsMs = np.rint(np.cumsum(dur)*1000).astype(np.int64)
+		
+		# Merge runs of consecutive steps with the same state into single segments, so the 
+		# volume is only set when it actually changes
+		isChange = np.ones(self._on.size, dtype=bool)
+		isChange[1:] = self._on[1:] != self._on[:-1]
+		boundaries = np.flatnonzero(isChange)
+		self._segOn = self._on[boundaries]
+		# End time of each segment, in milliseconds from the start of the sequence
+		self._segEndsMs = stepEndsMs[np.append(boundaries[1:], self._on.size) - 1] if boundaries.size else stepEndsMs
+		# Start and end time of each segment in ns, as used by the toggling thread
+		self._segEndsNs = self._segEndsMs * 1000000
+		self._segStartsNs = np.zeros(self._segOn.size, dtype=np.int64)
+		self._segStartsNs[1:] = self._segEndsNs[:-1]
+		
 		self.micName = micName
+		self.onFinished = onFinished
+		self.volumeControl = None
 		self.setLevel(level)
 		self.currentlyToggling = False
+		self._stopEvent = threading.Event()
+		self.t = None # toggling thread, created by run
 		self.setMicAsDefault(micName)
 
 	def stop(self):
-		'''Stop toggling and return microphone volume to full.  Only call after start since
-		otherwise self.t will not be defined'''
-		self.t.cancel()
+		'''Stop toggling and return microphone volume to full.  Only signals the toggling
+		thread, which restores the volume as it exits, so this never waits on it.  Safe
+		to call before run or after the sequence has finished.'''
 		self.currentlyToggling = False
-		self.makeMicLoud() # set to full volume at conclusion.
+		self._stopEvent.set() # wakes the toggling thread if it is waiting for a step
+		if self.t is None or not self.t.is_alive():
+			self.makeMicLoud() # no thread left to do it
 		
 	def setMicVol(self, volBool):
 		'''Set microphone volume to full  (if volBool) or silent (else)'''
@@ -245,33 +612,99 @@ class MicToggler():
 	
 	def makeMicLoud(self):
 		'''Turn microphone volume to full (defined by self.level)'''
-		print 'make loud'
 		if os.name == 'posix':
 			return
-		sp.call([self.appPath, 'setsysvolume', self.level, self.micName])
+		if self.volumeControl is not None and self.volumeControl.makeLoud():
+			return
+		sp.call(self._loudArgs)
 	
 	def makeMicSilent(self):
 		'''Turn microphone volume to 0; do not mute'''
-		print 'make silent'
 		if os.name == 'posix':
 			return
-		sp.call([self.appPath, 'setsysvolume', '0', self.micName])
-		
-	def __doStep(self):
-		self.t.cancel()
-		self.setMicVol(self.sequence[self.iStep][0])
-		if self.iStep < len(self.sequence) and self.currentlyToggling:
-			self.iStep += 1
-			self.t = threading.Timer(self.sequence[self.iStep][1], self.__doStep)
-			self.t.start()
-		else:
-			self.stop()
+		if self.volumeControl is not None and self.volumeControl.makeSilent():
+			return
+		sp.call(self._silentArgs)
+		
+	def __toggle(self, stopEvent):
+		'''Body of the toggling thread started by run.  Sets the volume for each step at
+		its scheduled start time, then returns the microphone to full volume once the
+		last step is over or stopEvent is set.  Start times are all measured from a single
+		starting point, so delays in one step do not push back the rest of the sequence.'''
+		if os.name == 'nt':
+			# Keep step timing from being held up by other threads (e.g. the GUI)
+			kernel32 = ctypes.windll.kernel32
+			kernel32.SetThreadPriority(kernel32.GetCurrentThread(), self.THREAD_PRIORITY_TIME_CRITICAL)
+			# EndpointVolume makes COM calls, which need COM set up on this thread
+			ctypes.windll.ole32.CoInitializeEx(None, self.COINIT_MULTITHREADED)
+		volumeControl = self.volumeControl
+		if volumeControl is not None:
+			volumeControl.attach()
+		# The sequence is fixed for the whole run, so work out everything about each step
+		# beforehand: when it starts and ends (in ns from the start of the sequence) and 
+		# which volume function it calls.  The loop is then just a wait and a call per step.
+		(loud, silent) = (self.makeMicLoud, self.makeMicSilent)
+		steps = zip(self._segStartsNs.tolist(), self._segEndsNs.tolist(),
+			[loud if isOn else silent for isOn in self._segOn.tolist()])
+		lastEnd = steps[-1][1] if steps else 0
+		(wait, now, collect) = (stopEvent.wait, _monotonic_ns, gc.collect)
+		(minGap, maxInterval) = (int(self.gcMinGap*1e9), int(self.gcMaxInterval*1e9))
+		finished = False
+		# Rather than let a collection start at any moment (in any thread) and delay a 
+		# step, collect just after the volume is set, when the next step is furthest away.
+		# Only the two younger generations are collected, which keeps each collection 
+		# short; the oldest is left until automatic collection is back on.
+		MicToggler.__holdGc()
+		startTime = lastCollect = now()
+		try:
+			for (stepStart, stepEnd, setVolume) in steps:
+				if wait(max(0, (startTime + stepStart - now())*1e-9)):
+					return
+				setVolume()
+				t = now()
+				if startTime + stepEnd - t > minGap or t - lastCollect > maxInterval:
+					collect(1)
+					lastCollect = t
+			finished = not wait(max(0, (startTime + lastEnd - now())*1e-9))
+		finally:
+			MicToggler.__releaseGc()
+			self.currentlyToggling = False
+			self.makeMicLoud() # set to full volume at conclusion.
+			if volumeControl is not None:
+				volumeControl.detach()
+			if os.name == 'nt':
+				ctypes.windll.ole32.CoUninitialize()
+		onFinished = self.onFinished # read once, as the GUI may clear it at any time
+		if finished and onFinished is not None:
+			onFinished()
+	
+	@classmethod
+	def __holdGc(cls):
+		'''Turn off automatic garbage collection until the matching __releaseGc.  Holds
+		from overlapping runs (e.g. one still exiting after a stop) are counted, so it is
+		only turned back on, and only if it was on to begin with, once all have ended.'''
+		with cls._gcLock:
+			if cls._gcHolds == 0:
+				cls._gcWasEnabled = gc.isenabled()
+				gc.disable()
+			cls._gcHolds += 1
+	
+	@classmethod
+	def __releaseGc(cls):
+		'''Undo one __holdGc'''
+		with cls._gcLock:
+			cls._gcHolds -= 1
+			if cls._gcHolds == 0 and cls._gcWasEnabled:
+				gc.enable()
 	
 	def run(self):
-		'''Start toggling the microphone volume according to the sequence'''
+		'''Start toggling the microphone volume according to the sequence, in a separate thread'''
 		self.currentlyToggling = True
-		self.iStep = 0
-		self.t = threading.Timer(0.01, self.__doStep)
+		# A fresh event for each run, so a thread that is still exiting from an earlier
+		# stop cannot be restarted by mistake
+		self._stopEvent = threading.Event()
+		self.t = threading.Thread(target=self.__toggle, args=(self._stopEvent,))
+		self.t.daemon = True
 		self.t.start()
 		
 	@staticmethod
@@ -284,17 +717,41 @@ class MicToggler():
 		
 	def setMicAsDefault(self, micName=""):
 		'''Set this microphone to be the default which will be turned up/down'''
-		if len(micName) > 0:
+		if len(micName) > 0 and micName != self.micName:
 			self.micName = micName
+			self.__setVolumeArgs()
 		if os.name == 'posix':
 			print 'set default mic'
 			return
 		sp.call([self.appPath, 'setdefaultsounddevice', self.micName, '1']) # default multimedia device
 		sp.call([self.appPath, 'setdefaultsounddevice', self.micName, '2']) # default communications device
+		
+		# Control the volume in-process if possible, looking the device up only once
+		# (here); otherwise each step launches nircmd
+		if self.volumeControl is not None:
+			self.volumeControl.close()
+			self.volumeControl = None
+		for volumeClass in (EndpointVolume, MixerVolume):
+			try:
+				self.volumeControl = volumeClass(self.micName)
+				self.volumeControl.setLevel(self.percLevel)
+				break
+			except Exception:
+				self.volumeControl = None
 
 	def setLevel(self, percLevel):
 		'''Set level (0-100) to use as 'full volume' level fo rhte microphone'''
+		self.percLevel = percLevel
 		self.level = str(int(65536.*percLevel/100.))
+		self.__setVolumeArgs()
+		if self.volumeControl is not None:
+			self.volumeControl.setLevel(percLevel)
+		
+	def __setVolumeArgs(self):
+		'''Build the nircmd command lines used by makeMicLoud/makeMicSilent once, rather
+		than on every step'''
+		self._loudArgs = [self.appPath, 'setsysvolume', self.level, self.micName]
+		self._silentArgs = [self.appPath, 'setsysvolume', '0', self.micName]
 
 def test_step_distribution():
 
@@ -339,7 +796,7 @@ def test_step_distribution():
 	newsteps = StepDistribution(filename)
 	newsteps.save_distribution()
 	
-	mt = MicToggler(steps.stepList)
+	mt = MicToggler(steps)
 	mt.showMicList()
 	mt.setMicAsDefault()
 	t = threading.Timer(10.0, mt.stop)
@@ -347,6 +804,7 @@ def test_step_distribution():
 	mt.start()
 	
 class TogglerGui(wx.Frame):
+	closeTimeout = 5 # longest to wait (s) for the toggling thread to finish on closing
   
 	def __init__(self):
 		'''Create the TogglerGui object.  After initialization it will have the following 
@@ -380,6 +838,7 @@ class TogglerGui(wx.Frame):
 			title='MicToggler', 
 			size=(850, 700)) # this is the default size (w x h) of the app in pixels
 		self.theDistribution = []
+		self.theToggler = None
 		self.Centre()
 		self.InitUI()
 		self.Show()
@@ -407,6 +866,7 @@ class TogglerGui(wx.Frame):
 		self.Bind(wx.EVT_MENU, self.onLoad, self.load)
 		self.Bind(wx.EVT_MENU, self.onSave, self.save)
 		self.Bind(wx.EVT_MENU, self.onQuit, self.quit)
+		self.Bind(wx.EVT_CLOSE, self.onClose)
 		
 		# Disable save upon opening application, until data is there to save
 		self.save.Enable(False)
@@ -762,26 +1222,64 @@ class TogglerGui(wx.Frame):
 				return
 		self.Close()		
 		
+	def onClose(self, event):
+		'''Function called when the window is closed.  The toggling thread is a daemon 
+		thread, so it would be killed on exit (possibly with the microphone silent); stop
+		it and give it time to return the microphone to full volume first.'''
+		if self.theToggler is not None:
+			# A sequence ending just now must not report back to the window being destroyed
+			self.theToggler.onFinished = None
+			self.theToggler.stop()
+			if self.theToggler.t is not None:
+				self.theToggler.t.join(self.closeTimeout)
+		event.Skip() # go on to destroy the window
+		
 	def onGenerate(self, event):
-		'''Function called when the 'generate' button is pressed'''
+		'''Function called when the 'generate' button is pressed.  The sequence is generated
+		in a separate thread so that the window stays responsive; onGenerated is called 
+		back on the GUI thread once it is ready.'''
 		self.generate.Enable(False) # Disable this button until generation is complete
 		
-		# Create the StepDistribution based on the sequence parameters
-		self.theDistribution = StepDistribution(self.getDistParams())
+		worker = threading.Thread(target=self.generateInBackground, args=(self.getDistParams(),))
+		worker.daemon = True
+		worker.start()
 		
-		# Display statistics about the particular sequence generated
-		self.setStats(self.theDistribution.params) 
+	def generateInBackground(self, params):
+		'''Runs in a worker thread: creates the StepDistribution and hands it back to the 
+		GUI thread.  Must not touch any wx objects directly.'''
+		try:
+			# Create the StepDistribution based on the sequence parameters
+			distribution = StepDistribution(params)
+		except:
+			wx.CallAfter(wx.MessageBox, "Sequence could not be generated: " + str(sys.exc_info()[0]) + str(sys.exc_info()[1]))
+			wx.CallAfter(self.generate.Enable, True)
+			return
+		wx.CallAfter(self.onGenerated, distribution)
 		
-		self.flagUnsaved(True)
+	def onGenerated(self, distribution):
+		'''Called on the GUI thread once a new sequence has been generated'''
+		self.theDistribution = distribution
 		
-		self.save.Enable(True) # Allow saving now that we have a sequence
-		self.startButton.Enable(True) # Allow starting toggling
-		self.generate.Enable(True) # Re-enable this button after generation is complete
+		# Freeze the frame so the label and button updates below are repainted once, 
+		# together, rather than one control at a time
+		self.Freeze()
+		try:
+			# Display statistics about the particular sequence generated
+			self.setStats(self.theDistribution.params) 
+			
+			self.flagUnsaved(True)
+			
+			self.save.Enable(True) # Allow saving now that we have a sequence
+			self.startButton.Enable(True) # Allow starting toggling
+			self.generate.Enable(True) # Re-enable this button after generation is complete
+		finally:
+			self.Thaw()
 		
 	def onStart(self, event):
-		# Create mictoggler and start
-		self.theToggler = MicToggler(self.theDistribution.stepList, level=self.micLevelSlider.GetValue(), 
-			micName=self.micChoice.GetValue())
+		# Create mictoggler and start.  It toggles in its own thread (never the GUI thread),
+		# so it reports back through wx.CallAfter
+		self.theToggler = MicToggler(self.theDistribution, level=self.micLevelSlider.GetValue(), 
+			micName=self.micChoice.GetValue(), onFinished=lambda: wx.CallAfter(self.onFinished))
 		
 		self.startButton.Enable(False)
 		self.stopButton.Enable(True)
@@ -791,6 +1289,11 @@ class TogglerGui(wx.Frame):
 		self.theToggler.stop()
 		self.startButton.Enable(True)
 		self.stopButton.Enable(False)
+		
+	def onFinished(self):
+		'''Called on the GUI thread when the toggler reaches the end of the sequence'''
+		self.startButton.Enable(True)
+		self.stopButton.Enable(False)
 	
 	def onShowMic(self, event):
 		MicToggler.showMicList()
@@ -806,7 +1309,24 @@ class TogglerGui(wx.Frame):
 	
 def make_gui():
 	app = wx.App()
-	TogglerGui()
-	app.MainLoop()
+	frame = TogglerGui()
+	
+	# Run the event loop directly instead of app.MainLoop(), with Pending and Dispatch
+	# bound to locals.  A destroyed frame tests False, which ends the loop before it 
+	# would block in Dispatch waiting for events that will never come.  (Classic 
+	# wxPython's EventLoopActivator is not a context manager, so the loop is made the
+	# active one by hand.)
+	evtloop = wx.GUIEventLoop()
+	oldLoop = wx.EventLoopBase.GetActive()
+	wx.EventLoopBase.SetActive(evtloop)
+	try:
+		(pending, dispatch, processIdle) = (evtloop.Pending, evtloop.Dispatch, evtloop.ProcessIdle)
+		while frame:
+			while pending():
+				dispatch()
+			if not processIdle() and frame:
+				dispatch() # nothing left to do when idle, so wait for the next event
+	finally:
+		wx.EventLoopBase.SetActive(oldLoop)
 
 make_gui()
\ No newline at end of file
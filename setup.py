@@ -11,4 +11,10 @@ sys.path.append("C:\\Users\\Kim\\Google Drive\\mictoggler\\dist\\dlls")
 
 data_files = [("x86_microsoft.vc90.crt", glob(r'C:\Users\Kim\Google Drive\mictoggler\dist\dlls\*.*'))]
 
-setup(data_files=data_files, console=['mictoggler.py'])
\ No newline at end of file
+# Bundle everything (with -OO bytecode) into the exe itself rather than many small 
+# files, so startup reads less from disk.  unittest and pydoc are not excluded as
+# numpy imports them.
+setup(data_files=data_files, console=['mictoggler.py'],
+	zipfile=None,
+	options={'py2exe': {'optimize': 2, 'bundle_files': 1, 'compressed': True,
+		'excludes': ['Tkinter', 'tkinter', 'email']}})
\ No newline at end of file